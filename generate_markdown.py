@@ -1,16 +1,24 @@
 from collections import Counter, defaultdict
-from datetime import datetime
-from json import load
-from numpy import mean, median
-from os.path import join
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from functools import lru_cache
+from itertools import chain
+from numpy import arange, flatnonzero, float64, fromiter, inf, int32, lexsort, median, ndarray, partition
+from operator import itemgetter
+from os import replace
+from os.path import isfile, join
 from pathlib import Path
-from google.cloud import bigquery
-from pypistats import overall, recent
-from tqdm import tqdm
+from typing import NamedTuple
+from orjson import OPT_INDENT_2, dumps, loads
 
-badges = set(image.stem for image in Path('images').glob('*.svg'))
+badges = frozenset(image.stem for image in Path('images').glob('*.svg'))
 
 TOP_K = 20
+RESEARCH_PATH = join('data', 'research.json')
+TUTORIALS_PATH = join('data', 'tutorials.json')
+STARS_PATH = join('data', 'stars.json')
+CITATIONS_PATH = join('data', 'citations.json')
+PYPI_CACHE_PATH = join('data', 'pypi_cache.json')
 
 def colab_url(url: str) -> str:
     return f'[![Open In Colab](images/colab.svg)]({url})'
@@ -26,9 +34,23 @@ def git_url(url: str) -> str:
 def pypi_url(package: str, period='dm') -> str:
     return f'[![](https://img.shields.io/pypi/{period}/{package}?style=flat&logo=pypi&label=%E2%80%8D&labelColor=f7f7f4&color=006dad)](https://pypi.org/{package}/)'
 
+def html_list(items: list[str], sep: str = ' ') -> str:
+    return f'<ul>{sep.join(items)}</ul>'
+
+@lru_cache(maxsize=None)
+def format_date(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp).strftime('%d.%m.%Y')
+
+@lru_cache(maxsize=None)
 def read_json(filepath: str):
-    with open(filepath, 'r', encoding='utf-8') as f:
-        return load(f)
+    with open(filepath, 'rb') as f:
+        return loads(f.read())
+
+def write_json(filepath: str, data):
+    tmp_filepath = f'{filepath}.tmp'
+    with open(tmp_filepath, 'wb') as f:
+        f.write(dumps(data, option=OPT_INDENT_2))
+    replace(tmp_filepath, filepath)
 
 def parse_link(link_tuple: list[list[str]], height=20) -> str:
     name, url = link_tuple
@@ -39,9 +61,10 @@ def parse_link(link_tuple: list[list[str]], height=20) -> str:
 def parse_authors(authors: list[tuple[str, str]], num_of_visible: int) -> str:
     if len(authors) == 1:
         return '[{}]({})'.format(*authors[0])
+    items = [f'<li>[{author}]({link})</li>' for author,link in authors]
     if len(authors) <= num_of_visible + 1:
-        return '<ul>' + ' '.join(f'<li>[{author}]({link})</li>' for author,link in authors[:num_of_visible + 1]) + '</ul>'
-    return '<ul>' + ' '.join(f'<li>[{author}]({link})</li>' for author,link in authors[:num_of_visible]) + '<details><summary>others</summary>' + ' '.join(f'<li>[{author}]({link})</li>' for author,link in authors[num_of_visible:]) + '</ul></details>'
+        return html_list(items)
+    return f"<ul>{' '.join(items[:num_of_visible])}<details><summary>others</summary>{' '.join(items[num_of_visible:])}</ul></details>"
 
 def parse_links(list_of_links: list[tuple[str, str]]) -> str:
     if len(list_of_links) == 0:
@@ -63,61 +86,87 @@ def parse_links(list_of_links: list[tuple[str, str]]) -> str:
     if len(dct) == 0:
         return line
 
-    return line + '<ul>' + ''.join('<li>' + ', '.join(parse_link((name, url)) for url in dct[name]) + '</li>' for name in dct.keys()) + '</ul>'
+    return line + html_list([f"<li>{', '.join([parse_link((name, url)) for url in dct[name]])}</li>" for name in sorted(dct)], sep='')
+
+@lru_cache(maxsize=None)
+def get_projects() -> list[dict]:
+    return read_json(RESEARCH_PATH) + read_json(TUTORIALS_PATH)
+
+class Indices(NamedTuple):
+    authors: Counter
+    num_of_authors: ndarray
+    repos: dict[tuple[str, str], tuple[str, int, str]]
+    papers: dict[str, tuple[str, int]]
+    citations: dict[str, tuple[str, int]]
+    packages: set[str]
+
+@lru_cache(maxsize=None)
+def build_indices() -> Indices:
+    projects = get_projects()
+    authors = Counter()
+    repos, papers, citations, packages = {}, {}, {}, set()
+    for project in projects:
+        authors.update(map(tuple, project['author']))
+        used = set()
+        for link in project['links']:
+            if link[0] == 'git' and 'git' not in used:
+                _, url, stars = link
+                prefix, _, tail = url.partition('com/')
+                owner, _, rest = tail.partition('/')
+                repo, _, _ = rest.partition('/')
+                repos[owner, repo] = (f'{prefix}com/{owner}/{repo}', stars, repo)
+                used.add('git')
+            elif link[0] == 'doi' and 'doi' not in used:
+                _, url, num_citations = link
+                if url not in papers or num_citations > papers[url][1]:
+                    papers[url] = (project['name'], num_citations)
+                citations[project['name']] = (url, num_citations)
+                used.add('doi')
+            elif link[0] == 'pypi':
+                packages.add(link[1].rstrip('/').split('/')[-1])
+
+    num_of_authors = fromiter((len(project['author']) for project in projects), dtype=int32, count=len(projects))
+
+    return Indices(authors, num_of_authors, repos, papers, citations, packages)
 
 def get_top_authors(topK) -> tuple[str, int]:
     global TOP_K
-    research = read_json(join('data', 'research.json'))
-    tutorials = read_json(join('data', 'tutorials.json'))
-    
-    authors, num_of_authors = [], []
-    for project in research + tutorials:
-        authors.extend([tuple(author) for author in project['author']])
-        num_of_authors.append(len(project['author']))
-    cnt = Counter(authors)
-    most_common = cnt.most_common()
+    indices = build_indices()
+    cnt, num_of_authors = indices.authors, indices.num_of_authors
+    most_common = cnt.most_common(topK * 4)
     contributions = most_common[topK][1]
     idx = topK
     while idx < len(most_common) and most_common[idx][1] == contributions:
         idx += 1
-    num_of_visible = int(min(mean(num_of_authors), median(num_of_authors)))
+        if idx == len(most_common) and idx < len(cnt):
+            most_common = cnt.most_common()
+    num_of_visible = int(min(num_of_authors.mean(), median(num_of_authors)))
     TOP_K = idx
     
-    return '<ul>' + ' '.join(f'<li>[{author}]({link})</li>' for (author,link),_ in most_common[:idx]) + '</ul>', num_of_visible
+    return html_list([f'<li>[{author}]({link})</li>' for (author,link),_ in most_common[:idx]]), num_of_visible
 
 def get_top_repos(topK) -> str:
-    research = read_json(join('data', 'research.json'))
-    tutorials = read_json(join('data', 'tutorials.json'))
-    repos = {}
-    for project in research + tutorials:
-        for link in project['links']:
-            if link[0] == 'git':
-                _, url, stars = link
-                idx = url.index('/', 19) + 1
-                idx = url.find('/', idx)
-                key = url[:idx] if idx != -1 else url
-                repos[key] = stars
-                break
-    repos = sorted(repos.items(), key=lambda f: f[1], reverse=True)[:topK]
+    repos = sorted(build_indices().repos.values(), key=itemgetter(1), reverse=True)[:topK]
     
-    return '<ul>' + ' '.join(f"<li>{url.split('com/')[1].split('/')[1]}\t{git_url(url)}</li>" for url,_ in repos) + '</ul>'
+    return html_list([f"<li>{name}\t{git_url(url)}</li>" for url,_,name in repos])
 
 def get_top_papers(topK) -> str:
-    research = read_json(join('data', 'research.json'))
-    tutorials = read_json(join('data', 'tutorials.json'))
-    repos = {}
-    for project in research + tutorials:
-        for link in project['links']:
-            if link[0] == 'doi':
-                if link[1] not in repos or link[2] > repos[link[1]][1]:
-                    repos[link[1]] = (project['name'], link[2])
-                break
-    repos = sorted([(name, url, citations) for url, (name, citations) in repos.items()], key=lambda f: f[2], reverse=True)[:topK]
+    papers = sorted([(name, url, citations) for url, (name, citations) in build_indices().papers.items()], key=itemgetter(2), reverse=True)[:topK]
     
-    return '<ul>' + ' '.join(f"<li>{name}\t{doi_url(url)}</li>" for name,url,_ in repos) + '</ul>'
+    return html_list([f"<li>{name}\t{doi_url(url)}</li>" for name,url,_ in papers])
+
+def top_k_indices(values: ndarray, topK: int) -> ndarray:
+    if topK <= 0:
+        return arange(0)
+    if topK < len(values):
+        threshold = partition(values, len(values) - topK)[len(values) - topK]
+        candidates = flatnonzero(values >= threshold)
+    else:
+        candidates = arange(len(values))
+    return candidates[lexsort((candidates, -values[candidates]))][:topK]
 
 def get_best_of_the_best(authors: str, packages, topK: int) -> str:
-    packages_str = '<ul>' + ' '.join(f'<li>{package}\t{pypi_url(package)}</li>' for package,_,_ in sorted(packages, key=lambda p: p[2], reverse=True)[:topK]) + '</ul>'
+    packages_str = html_list([f'<li>{package}\t{pypi_url(package)}</li>' for package,_,_ in sorted(packages, key=itemgetter(2), reverse=True)[:topK]])
     table = f'''| authors | repositories | papers | packages |
 |---|---|---|---|
 | {authors} | {get_top_repos(topK)} | {get_top_papers(topK)} | {packages_str} |'''
@@ -125,92 +174,82 @@ def get_best_of_the_best(authors: str, packages, topK: int) -> str:
 
 def generate_table(fn: str, num_visible_authors: int):
     data = read_json(fn)
-    colabs = sorted(data, key=lambda kv: kv['update'], reverse=True)
-    to_write = [
-        '| name | description | authors | links | colaboratory | update |',
-        '|------|-------------|:--------|:------|:------------:|:------:|',
-    ]
+    colabs = sorted(data, key=itemgetter('update'), reverse=True)
+    yield '| name | description | authors | links | colaboratory | update |'
+    yield '|------|-------------|:--------|:------|:------------:|:------:|'
     for line in colabs:
-        line['author'] = parse_authors(line['author'], num_visible_authors)
-        line['links'] = parse_links(sorted(line['links'], key=lambda x: x[0]))
-        line['url'] = colab_url(line['colab'])
-        line['update'] = datetime.fromtimestamp(line['update']).strftime('%d.%m.%Y')
-        to_write.append('| {name} | {description} | {author} | {links} | {url} | {update} |'.format(**line))
-    return to_write
+        row = {
+            'name': line['name'],
+            'description': line['description'],
+            'author': parse_authors(line['author'], num_visible_authors),
+            'links': parse_links(line['links']),
+            'url': colab_url(line['colab']),
+            'update': format_date(line['update']),
+        }
+        yield '| {name} | {description} | {author} | {links} | {url} | {update} |'.format(**row)
 
 def get_pypi_downloads(engine: str = 'pypistats'):
-    research = read_json(join('data', 'research.json'))
-    tutorials = read_json(join('data', 'tutorials.json'))
-    packages = set()
-    for project in research + tutorials:
-        for url in project['links']:
-            if url[0] == 'pypi':
-                packages.add(url[1].rstrip('/').split('/')[-1])
+    packages = build_indices().packages
     if engine == 'bigquery':
-        def get_query(date_filtering: str) -> str:
-            return f"""
+        from google.cloud import bigquery
+        client = bigquery.Client()
+        query_job = client.query(f"""
             SELECT
                 file.project,
-                COUNT(*) AS num_downloads
+                COUNTIF(DATE(timestamp) BETWEEN DATE_SUB(DATE_TRUNC(CURRENT_DATE(), MONTH), INTERVAL 1 MONTH)
+                AND DATE_SUB(DATE_TRUNC(CURRENT_DATE(), MONTH), INTERVAL 1 DAY)) AS num_downloads_last_month,
+                COUNT(*) AS total_num_downloads
             FROM
                 `bigquery-public-data.pypi.file_downloads`
             WHERE
                 file.project IN ('{"', '".join(packages)}')
-                AND DATE(timestamp) BETWEEN {date_filtering}
+                AND DATE(timestamp) BETWEEN DATE_SUB(CURRENT_DATE(), INTERVAL 1 YEAR) AND CURRENT_DATE()
             GROUP BY
                 file.project
-            """
-        client = bigquery.Client()
-        last_month = 'DATE_SUB(DATE_TRUNC(CURRENT_DATE(), MONTH), INTERVAL 1 MONTH) AND DATE_SUB(DATE_TRUNC(CURRENT_DATE(), MONTH), INTERVAL 1 DAY)'
-        total = 'DATE_SUB(CURRENT_DATE(), INTERVAL 1 YEAR) AND CURRENT_DATE()'
-        query_last_month = client.query(get_query(last_month))
-        query_total = client.query(get_query(total))
-        # query_job = client.query(f"""
-        #     SELECT
-        #         file.project,
-        #         COUNTIF(DATE(timestamp) BETWEEN DATE_SUB(DATE_TRUNC(CURRENT_DATE(), MONTH), INTERVAL 1 MONTH)
-        #         AND DATE_SUB(DATE_TRUNC(CURRENT_DATE(), MONTH), INTERVAL 1 DAY)) AS num_downloads_last_month,
-        #         COUNT(*) AS total_num_downloads
-        #     FROM
-        #         `bigquery-public-data.pypi.file_downloads`
-        #     WHERE
-        #         file.project IN ('{"', '".join(packages)}')
-        #     GROUP BY
-        #         file.project
-        # """)
-        res_last_month = {row.project: row.num_downloads for row in query_last_month.result()}
-        res_total = {row.project: row.num_downloads for row in query_total.result()}
-
-        return [(package, res_last_month[package], res_total[package]) for package in packages]
-    return [(package, int(recent(package, format='pandas').last_month), int(overall(package, format='pandas').query('category == "Total"').downloads)) for package in tqdm(packages)]
+        """)
+
+        return [(row.project, row.num_downloads_last_month, row.total_num_downloads) for row in query_job.result()]
+    cache = dict(read_json(PYPI_CACHE_PATH)) if isfile(PYPI_CACHE_PATH) else {}
+    today = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    stale = [package for package in packages if package not in cache or cache[package][0] != today]
+    if stale:
+        from pypistats import overall, recent
+        from tqdm import tqdm
+        def get_downloads(package: str) -> tuple[str, int, int]:
+            return package, int(recent(package, format='pandas').last_month), int(overall(package, format='pandas').query('category == "Total"').downloads)
+        errors = []
+        try:
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                futures = [executor.submit(get_downloads, package) for package in stale]
+                for future in tqdm(as_completed(futures), total=len(futures)):
+                    try:
+                        package, last_month, total = future.result()
+                    except Exception as e:
+                        errors.append(e)
+                        continue
+                    cache[package] = [today, last_month, total]
+        finally:
+            write_json(PYPI_CACHE_PATH, {package: cache[package] for package in packages if package in cache})
+        if errors:
+            raise errors[0]
+    return [(package, cache[package][1], cache[package][2]) for package in packages]
 
 
 def get_trending(packages, topK: int):
-    old_stars = read_json('data/stars.json')
-    old_citations = read_json('data/citations.json')
-    research = read_json(join('data', 'research.json'))
-    tutorials = read_json(join('data', 'tutorials.json'))
-    new_stars, new_citations = {}, {}
-    for project in research + tutorials:
-        used = set()
-        for link in project['links']:
-            if link[0] == 'git' and 'git' not in used:
-                _, url, stars = link
-                idx = url.index('/', 19) + 1
-                idx = url.find('/', idx)
-                key = url[:idx] if idx != -1 else url
-                new_stars[key] = stars
-                used.add('git')
-            elif link[0] == 'doi' and 'doi' not in used:
-                _, url, citations = link
-                new_citations[project['name']] = (url, citations)
-                used.add('doi')
-    trending_repos = sorted(new_stars, key=lambda url: new_stars[url] / old_stars.get(url, float('inf')), reverse=True)[:topK]
-    trending_papers = sorted(new_citations, key=lambda name: new_citations[name][1] / max(old_citations.get(name, ['', float('inf')])[1], 1), reverse=True)[:topK]
-    trending_packages = sorted(packages, key=lambda p: p[1]/ (p[2] - p[1]), reverse=True)[:topK]
-    repos_str = '<ul>' + ' '.join(f"<li>{url.split('com/')[1].split('/')[1]}\t{git_url(url)}</li>" for url in trending_repos) + '</ul>'
-    papers_str = '<ul>' + ' '.join(f"<li>{name}\t{doi_url(new_citations[name][0])}</li>" for name in trending_papers) + '</ul>'
-    packages_str = '<ul>' + ' '.join(f'<li>{package}\t{pypi_url(package, period="dw")}</li>' for package,_,_ in trending_packages) + '</ul>'
+    old_stars = read_json(STARS_PATH)
+    old_citations = read_json(CITATIONS_PATH)
+    indices = build_indices()
+    new_stars, new_citations = indices.repos, indices.citations
+    repos, papers = list(new_stars.values()), list(new_citations.items())
+    repos_growth = fromiter((stars / old_stars.get(url, inf) for url, stars, _ in repos), dtype=float64, count=len(repos))
+    papers_growth = fromiter((citations / max(old_citations.get(name, ['', inf])[1], 1) for name, (_, citations) in papers), dtype=float64, count=len(papers))
+    packages_growth = [(package, last_month / (total - last_month)) for package, last_month, total in packages]
+    trending_repos = [repos[idx] for idx in top_k_indices(repos_growth, topK)]
+    trending_papers = [papers[idx] for idx in top_k_indices(papers_growth, topK)]
+    trending_packages = sorted(packages_growth, key=itemgetter(1), reverse=True)[:topK]
+    repos_str = html_list([f"<li>{name}\t{git_url(url)}</li>" for url,_,name in trending_repos])
+    papers_str = html_list([f"<li>{name}\t{doi_url(url)}</li>" for name,(url,_) in trending_papers])
+    packages_str = html_list([f'<li>{package}\t{pypi_url(package, period="dw")}</li>' for package,_ in trending_packages])
     
     return f'''| repositories | papers | packages |
 |---|---|---|
@@ -219,7 +258,7 @@ def get_trending(packages, topK: int):
 def generate_markdown():
     top_authors, num_visible_authors = get_top_authors(TOP_K)
     packages = get_pypi_downloads()
-    to_write = [
+    to_write = chain([
         '[![Hits](https://hits.seeyoufarm.com/api/count/incr/badge.svg?url=https://github.com/amrzv/awesome-colab-notebooks)](https://hits.seeyoufarm.com)',
         '![awesome-colab-notebooks](https://count.getloli.com/get/@awesome-colab-notebooks?theme=rule34)',
         '\nThe page might not be rendered properly. Please open [README.md](https://github.com/amrzv/awesome-colab-notebooks/blob/main/README.md) file directly',
@@ -227,16 +266,20 @@ def generate_markdown():
         '## Trending',
         get_trending(packages, TOP_K),
         '## Research',
-        *generate_table(join('data', 'research.json'), num_visible_authors),
+    ], generate_table(RESEARCH_PATH, num_visible_authors), [
         '## Tutorials',
-        *generate_table(join('data', 'tutorials.json'), num_visible_authors),
+    ], generate_table(TUTORIALS_PATH, num_visible_authors), [
         '# Best of the best',
         get_best_of_the_best(top_authors, packages, TOP_K),
         '\n[![Stargazers over time](https://starchart.cc/amrzv/awesome-colab-notebooks.svg?variant=adaptive)](https://starchart.cc/amrzv/awesome-colab-notebooks)',
         '\n(generated by [generate_markdown.py](generate_markdown.py) based on [research.json](data/research.json) and [tutorials.json](data/tutorials.json))'
-    ]
-    with open('README.md', 'w', encoding='utf-8') as f:
-        f.write('\n'.join(to_write))
+    ])
+    with open('README.md.tmp', 'w', encoding='utf-8', buffering=1 << 16) as f:
+        f.write(next(to_write))
+        for line in to_write:
+            f.write('\n')
+            f.write(line)
+    replace('README.md.tmp', 'README.md')
 
 def main():
     generate_markdown()